@@ -15,8 +15,8 @@ Supports:
     &q=lemma:aspicio
     &title="Gallic War"
     &author=Caesar
-    &start=0
-    &end=0
+    &start=1
+    &end=5000
     &format=json
 
 ID format
@@ -46,13 +46,25 @@ identifies the specific cited passage/hit).
 
 import argparse
 import csv
+import functools
 import html
 import re
 import sys
-from typing import Dict, List, Any
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from typing import Dict, Iterable, Iterator, List, Tuple, Any
 from urllib.parse import urljoin
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # optional, much faster decoding of large JSON responses
+except ImportError:
+    orjson = None
 
 # Language-dependent configuration
 LANG_CONFIG = {
@@ -70,10 +82,57 @@ LANG_CONFIG = {
 BASE_QUERY_URL = LANG_CONFIG["Latin"]["query_url"]
 BASE_NAV_URL = LANG_CONFIG["Latin"]["nav_url"]
 
-TAG_RE = re.compile(r"<[^>]+>")
-HIGHLIGHT_RE = re.compile(
-    r'<span[^>]*class="[^"]*highlight[^"]*"[^>]*>(.*?)</span>',
-    re.IGNORECASE | re.DOTALL,
+# Upper bound for "end" when fetching every result in a single request
+ALL_RESULTS_END = 10_000_000
+# Default --page-size: most queries still fit in one request, while very
+# frequent lemmas are streamed page by page with bounded memory
+DEFAULT_PAGE_SIZE = 5000
+# Number of follow-up pages fetched concurrently when results are paged
+PAGE_WORKERS = 4
+# Maximum number of lemmas queried concurrently
+LEMMA_WORKERS = 8
+# Write buffer for the output CSV, so large outputs need few write() calls
+CSV_BUFFER_SIZE = 1 << 20
+# Contexts shorter than this are memoized by parse_context
+PARSE_CACHE_MAX_LEN = 8192
+
+# Splitting on a capturing tag pattern yields alternating text and tag
+# pieces (text first), so the HTML is tokenized once, in C.
+TAG_SPLIT_RE = re.compile(r"(<[^>]+>)")
+HIGHLIGHT_OPEN_RE = re.compile(
+    r'<span[^>]*class="[^"]*highlight[^"]*"[^>]*>',
+    re.IGNORECASE,
+)
+WS_RE = re.compile(r"\s+")
+BYTE_RE = re.compile(r"byte=(\d+)")
+# One pass over the text: drop whitespace after an opening double quote “ or
+# before common punctuation (", . ; : ? !"), collapse any other run to " ".
+CONTEXT_WS_RE = re.compile(r"(?<=“)\s+|\s+(?=[,.;:?!])|(\s+)")
+
+# Shared HTTP session: every request to PhiloLogic reuses the same pooled
+# keep-alive connection instead of paying a fresh TCP+TLS handshake.
+# ACCEPT_ENCODING is every encoding urllib3 can decode here ("gzip,deflate",
+# plus "br" when brotli is installed), so compressed JSON is always readable.
+SESSION = requests.Session()
+SESSION.headers.update(
+    {
+        "Accept": "application/json",
+        "Accept-Encoding": ACCEPT_ENCODING,
+        "Connection": "keep-alive",
+        "User-Agent": "perseus-lemma-extractor/1.0",
+    }
+)
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=2,
+        pool_maxsize=max(PAGE_WORKERS, LEMMA_WORKERS),
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[500, 502, 503, 504],
+        ),
+    ),
 )
 
 
@@ -109,7 +168,7 @@ def build_query_params(
 def fetch_json(params: Dict[str, Any]) -> Dict[str, Any]:
     """Fetch JSON from PhiloLogic with the given params, or exit on error."""
     try:
-        resp = requests.get(BASE_QUERY_URL, params=params, timeout=60)
+        resp = SESSION.get(BASE_QUERY_URL, params=params, timeout=60)
     except requests.RequestException as e:
         print(f"Error contacting {BASE_QUERY_URL}: {e}", file=sys.stderr)
         sys.exit(1)
@@ -123,7 +182,8 @@ def fetch_json(params: Dict[str, Any]) -> Dict[str, Any]:
         sys.exit(1)
 
     try:
-        data = resp.json()
+        # orjson.JSONDecodeError is a subclass of ValueError
+        data = orjson.loads(resp.content) if orjson else resp.json()
     except ValueError as e:
         print(f"Response was not valid JSON: {e}", file=sys.stderr)
         sys.exit(1)
@@ -131,38 +191,191 @@ def fetch_json(params: Dict[str, Any]) -> Dict[str, Any]:
     return data
 
 
+def fetch_page(
+    lemmas: List[str],
+    author: str = None,
+    title: str = None,
+    start: int = 1,
+    page_size: int = 0,
+) -> Dict[str, Any]:
+    """
+    Fetch one page of results starting at `start` (1-based).
+
+    A page_size of 0 asks for every result in a single request.
+    """
+    end = start + page_size - 1 if page_size else ALL_RESULTS_END
+    params = build_query_params(
+        lemmas=lemmas,
+        author=author,
+        title=title,
+        start=start,
+        end=end,
+    )
+    return fetch_json(params)
+
+
+def iter_results(
+    first_page: Dict[str, Any],
+    lemmas: List[str],
+    author: str = None,
+    title: str = None,
+    page_size: int = 0,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yield every result of a query, starting from its already fetched first page.
+
+    If the first page holds fewer than results_length results (either because
+    page_size was given or because the server capped the response), the
+    remaining pages are fetched concurrently over the shared session and
+    yielded in order. At most PAGE_WORKERS pages are requested ahead of the
+    consumer, so only a handful of decoded pages are held in memory at once.
+
+    Pages are sized by what the server actually returned for the first page.
+    If a later page still comes back short, the gap is fetched before moving
+    on; results the server never returns are reported on stderr.
+    """
+    results = first_page.get("results") or []
+    yield from results
+
+    results_length = int(first_page.get("results_length", 0) or 0)
+    if len(results) >= results_length:
+        return
+    if not results:
+        _warn_missing(1, results_length)
+        return
+
+    step = min(page_size, len(results)) if page_size else len(results)
+    starts = iter(range(len(results) + 1, results_length + 1, step))
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        pending = deque(
+            (start, pool.submit(fetch_page, lemmas, author, title, start, step))
+            for start in islice(starts, PAGE_WORKERS)
+        )
+        while pending:
+            start, future = pending.popleft()
+            page_results = future.result().get("results") or []
+            # Keep the window full before handing this page's results out
+            for next_start in islice(starts, 1):
+                pending.append(
+                    (
+                        next_start,
+                        pool.submit(
+                            fetch_page, lemmas, author, title, next_start, step
+                        ),
+                    )
+                )
+            yield from page_results
+
+            # Fill in whatever a short page left out of [start, end)
+            end = min(start + step, results_length + 1)
+            start += len(page_results)
+            while page_results and start < end:
+                page = fetch_page(lemmas, author, title, start, end - start)
+                page_results = page.get("results") or []
+                yield from page_results
+                start += len(page_results)
+            if start < end:
+                _warn_missing(start, end - start)
+
+
+def _warn_missing(start: int, count: int) -> None:
+    """Report results the server did not return for a requested range."""
+    print(
+        f"Warning: server did not return results {start}-{start + count - 1}; "
+        f"{count} result(s) missing from the CSV.",
+        file=sys.stderr,
+    )
+
+
+def split_context(context_html: str) -> List[str]:
+    """Split context HTML into alternating text and tag pieces, text first."""
+    return TAG_SPLIT_RE.split(context_html)
+
+
+def highlight_tokens_from_pieces(pieces: List[str]) -> List[str]:
+    """
+    Collect the tokens marked by <span class="highlight">…</span> from the
+    output of split_context.
+
+    A highlight runs from its opening tag to the first closing </span>; any
+    nested tags inside it are replaced by a space.
+    """
+    tokens: List[str] = []
+    start = 0
+    for i in range(1, len(pieces), 2):
+        tag = pieces[i]
+        if not start:
+            if HIGHLIGHT_OPEN_RE.match(tag):
+                start = i + 1
+        elif tag.lower() == "</span>":
+            # Join the text pieces inside the span and unescape entities
+            text = html.unescape(" ".join(pieces[start:i:2]))
+            text = WS_RE.sub(" ", text).strip()
+            if text:
+                tokens.append(text)
+            start = 0
+    return tokens
+
+
 def extract_highlight_tokens(context_html: str) -> List[str]:
     """
     Extract tokens marked by <span class="highlight">…</span> in the context.
 
     Returns a list of cleaned surface forms.
     """
-    tokens: List[str] = []
-    for match in HIGHLIGHT_RE.finditer(context_html):
-        inner_html = match.group(1)
-        # Strip any nested tags and unescape entities
-        text = TAG_RE.sub(" ", inner_html)
-        text = html.unescape(text)
-        text = re.sub(r"\s+", " ", text).strip()
-        if text:
-            tokens.append(text)
-    return tokens
+    return highlight_tokens_from_pieces(split_context(context_html))
+
+
+def _context_ws_repl(match: "re.Match[str]") -> str:
+    """Replacement for CONTEXT_WS_RE: keep a single space only for plain runs."""
+    return " " if match.group(1) else ""
+
+
+def text_from_pieces(pieces: List[str]) -> str:
+    """Join the text pieces from split_context into a cleaned sentence."""
+    # Drop tags (each becomes a space) and unescape HTML entities
+    text = html.unescape(" ".join(pieces[::2]))
+    # Normalize whitespace and tidy punctuation/quote spacing in a single pass
+    text = CONTEXT_WS_RE.sub(_context_ws_repl, text)
+    return text.strip()
 
 
 def clean_context(context_html: str) -> str:
     """Strip HTML tags, clean whitespace, and tidy punctuation/quotes spacing."""
-    # Remove tags
-    text = TAG_RE.sub(" ", context_html)
-    # Unescape HTML entities
-    text = html.unescape(text)
-    # Normalize whitespace
-    text = re.sub(r"\s+", " ", text)
-    text = text.strip()
-    # Remove spaces before common punctuation (", . ; : ? !")
-    text = re.sub(r"\s+([,.;:?!])", r"\1", text)
-    # Remove spaces immediately after an opening double quote “
-    text = re.sub(r"“\s+", "“", text)
-    return text
+    return text_from_pieces(split_context(context_html))
+
+
+def _parse_context(context_html: str) -> Tuple[str, Tuple[str, ...]]:
+    """Uncached implementation of parse_context."""
+    pieces = split_context(context_html)
+    return text_from_pieces(pieces), tuple(highlight_tokens_from_pieces(pieces))
+
+
+_parse_context_cached = functools.lru_cache(maxsize=2048)(_parse_context)
+
+
+def parse_context(context_html: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Parse context HTML once and return (sentence, highlight tokens).
+
+    Equivalent to (clean_context(html), extract_highlight_tokens(html)), but
+    the HTML is only tokenized a single time. Results for contexts shorter
+    than PARSE_CACHE_MAX_LEN are memoized, since the same passage often comes
+    back several times (repeated passages, several lemmas in one sentence).
+    """
+    if len(context_html) < PARSE_CACHE_MAX_LEN:
+        return _parse_context_cached(context_html)
+    return _parse_context(context_html)
+
+
+# Shared read-only fallback for missing dict fields, so the per-result code
+# doesn't allocate a fresh empty dict on every lookup
+_EMPTY_DICT: Dict[str, Any] = {}
+
+
+def _strip(value: str) -> str:
+    """Strip a possibly missing (None/empty) string field."""
+    return value.strip() if value else ""
 
 
 def build_passage_url(citation_links: Dict[str, str]) -> str:
@@ -180,11 +393,9 @@ def build_passage_url(citation_links: Dict[str, str]) -> str:
 
     # If there is a ?byte= parameter, insert a trailing slash before it
     # to get ".../path/?byte=..."
-    if "?" in raw:
-        path, query = raw.split("?", 1)
-        if not path.endswith("/"):
-            path = path + "/"
-        raw = f"{path}?{query}"
+    q = raw.find("?")
+    if q != -1 and raw[q - 1 : q] != "/":
+        raw = f"{raw[:q]}/{raw[q:]}"
 
     return urljoin(BASE_NAV_URL, raw)
 
@@ -200,7 +411,7 @@ def build_unique_id(result: Dict[str, Any]) -> str:
     Example:
         77.5.14.2.636137_Caes.Gal.
     """
-    metadata = result.get("metadata_fields") or {}
+    metadata = result.get("metadata_fields") or _EMPTY_DICT
     doc_id = str(metadata.get("philo_doc_id", "")).strip()
 
     # Fallback: first element of philo_id
@@ -209,14 +420,14 @@ def build_unique_id(result: Dict[str, Any]) -> str:
         if isinstance(philo_id, list) and philo_id:
             doc_id = str(philo_id[0])
 
-    citation = result.get("citation") or []
+    citation = result.get("citation") or ()
     doc_label = ""
     div_labels: List[str] = []
     byte = ""
 
     for cit in citation:
         obj_type = (cit.get("object_type") or "").lower()
-        label = (cit.get("label") or "").strip()
+        label = _strip(cit.get("label"))
 
         if obj_type == "doc" and label and not doc_label:
             doc_label = label
@@ -226,93 +437,93 @@ def build_unique_id(result: Dict[str, Any]) -> str:
 
         href = cit.get("href") or ""
         if not byte and href:
-            m = re.search(r"byte=(\d+)", href)
+            m = BYTE_RE.search(href)
             if m:
                 byte = m.group(1)
 
+        # Nothing later in the citation can change the ID once all parts are known
+        if doc_label and byte and len(div_labels) >= 3:
+            break
+
     # Only keep up to three structural labels (e.g. 5.14.2)
     div_labels = div_labels[:3]
 
     # Fallback for byte: look in citation_links
     if not byte:
-        citation_links = result.get("citation_links") or {}
+        citation_links = result.get("citation_links") or _EMPTY_DICT
         for key in ("para", "line", "doc"):
             href = citation_links.get(key) or ""
-            m = re.search(r"byte=(\d+)", href)
+            m = BYTE_RE.search(href)
             if m:
                 byte = m.group(1)
                 break
 
-    parts: List[str] = []
-    if doc_id:
-        parts.append(doc_id)
-    parts.extend(div_labels)
-    if byte:
-        parts.append(byte)
-
-    base_id = ".".join(parts)
+    core = ".".join([p for p in (doc_id, *div_labels, byte) if p])
+    if not doc_label:
+        return core
 
-    if doc_label:
-        # Remove whitespace inside label: "Caes. Gal." -> "Caes.Gal."
-        doc_label_clean = re.sub(r"\s+", "", doc_label)
-        if base_id:
-            return f"{base_id}_{doc_label_clean}"
-        return doc_label_clean
+    # Remove whitespace inside label: "Caes. Gal." -> "Caes.Gal."
+    doc_label_clean = "".join(doc_label.split())
+    return f"{core}_{doc_label_clean}" if core else doc_label_clean
 
-    return base_id
 
+def iter_rows(
+    results: Iterable[Dict[str, Any]], lemma: str, language: str
+) -> Iterator[Tuple[str, ...]]:
+    """
+    Turn the PhiloLogic JSON results of a single-lemma query into CSV rows,
+    yielded one at a time.
 
-def extract_rows(data: Dict[str, Any], lemmas: List[str], language: str) -> List[Dict[str, str]]:
-    """Turn a PhiloLogic JSON response into a list of CSV rows."""
-    results = data.get("results", [])
-    rows: List[Dict[str, str]] = []
-
-    # Determine how to fill the LEMMA column
-    if len(lemmas) == 1:
-        lemma_value = lemmas[0]
-    else:
-        # For multiple lemmas we store the whole set as a semicolon-separated list.
-        # (PhiloLogic does not tell us which exact lemma matched each token.)
-        lemma_value = ";".join(lemmas)
+    Each row is a tuple in the column order written by write_csv, with
+    `lemma` in the LEMMA column.
+    """
+    # Bind the per-result helpers to locals once: this loop runs for every
+    # result, and local lookups are cheaper than global ones.
+    parse = parse_context
+    passage_url_for = build_passage_url
+    unique_id_for = build_unique_id
 
     for result in results:
         context_html = result.get("context", "")
-        tokens = extract_highlight_tokens(context_html)
-        sentence = clean_context(context_html)
+        sentence, tokens = parse(context_html)
 
-        metadata = result.get("metadata_fields", {}) or {}
-        author = (metadata.get("author") or "").strip()
-        title = (metadata.get("title") or "").strip()
+        metadata = result.get("metadata_fields") or _EMPTY_DICT
+        author = _strip(metadata.get("author"))
+        title = _strip(metadata.get("title"))
 
-        citation_links = result.get("citation_links", {}) or {}
-        passage_url = build_passage_url(citation_links)
+        citation_links = result.get("citation_links") or _EMPTY_DICT
+        passage_url = passage_url_for(citation_links)
 
-        unique_id = build_unique_id(result)
+        unique_id = unique_id_for(result)
 
         # Guarantee at least one row per result; if no highlight spans were found,
         # we still store one row with an empty TOKEN.
         if not tokens:
-            tokens = [""]
+            tokens = ("",)
 
         for token in tokens:
-            rows.append(
-                {
-                    "ID": unique_id,
-                    "TOKEN": token,
-                    "LEMMA": lemma_value,
-                    "SENTENCE": sentence,
-                    "author": author,
-                    "title": title,
-                    "language": language,
-                    "passage": passage_url,
-                }
+            yield (
+                unique_id,
+                token,
+                lemma,
+                sentence,
+                author,
+                title,
+                language,
+                passage_url,
             )
 
-    return rows
 
+def write_csv(
+    rows: Iterable[Tuple[str, ...]], output_path: str, bom: bool = False
+) -> int:
+    """
+    Write rows to CSV with the desired column order.
 
-def write_csv(rows: List[Dict[str, str]], output_path: str) -> None:
-    """Write rows to CSV with the desired column order."""
+    Rows are consumed lazily, so an iterator is never materialized in memory.
+    If bom is true, the file starts with a UTF-8 byte order mark (for Excel).
+    Returns the number of rows written.
+    """
     fieldnames = [
         "ID",
         "TOKEN",
@@ -323,11 +534,27 @@ def write_csv(rows: List[Dict[str, str]], output_path: str) -> None:
         "language",
         "passage",
     ]
-    with open(output_path, "w", encoding="utf-8", newline="") as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for row in rows:
+    encoding = "utf-8-sig" if bom else "utf-8"
+    with open(
+        output_path, "w", encoding=encoding, newline="", buffering=CSV_BUFFER_SIZE
+    ) as f:
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        count = 0
+        for count, row in enumerate(rows, 1):
             writer.writerow(row)
+    return count
+
+
+def non_negative_int(value: str) -> int:
+    """argparse type for integer options that must be 0 or greater."""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be 0 or greater, got {number}")
+    return number
 
 
 def parse_args() -> argparse.Namespace:
@@ -362,6 +589,21 @@ def parse_args() -> argparse.Namespace:
         default="Latin",
         help="Corpus language: Latin or Greek (default: Latin).",
     )
+    parser.add_argument(
+        "-p",
+        "--page-size",
+        type=non_negative_int,
+        default=DEFAULT_PAGE_SIZE,
+        help=(
+            f"Fetch results in pages of this size; 0 fetches everything in one "
+            f"request (default: {DEFAULT_PAGE_SIZE})."
+        ),
+    )
+    parser.add_argument(
+        "--bom",
+        action="store_true",
+        help="Start the CSV with a UTF-8 byte order mark (helps Excel detect the encoding).",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -388,42 +630,63 @@ def main() -> None:
         if args.title:
             print(f"Title filter:  {args.title}", file=sys.stderr)
 
-    # First query: end=0 to discover results_length
-    params_initial = build_query_params(
-        lemmas=args.lemmas,
-        author=args.author,
-        title=args.title,
-        start=0,
-        end=0,
-    )
-    data_initial = fetch_json(params_initial)
+    # One query per lemma, so every row carries the exact lemma it matched.
+    # The first page of each query is fetched concurrently.
+    # Repeated lemmas are queried once, keeping the order they were given in.
+    lemmas = list(dict.fromkeys(args.lemmas))
+    with ThreadPoolExecutor(max_workers=min(LEMMA_WORKERS, len(lemmas))) as pool:
+        first_pages = list(
+            pool.map(
+                lambda lemma: fetch_page(
+                    lemmas=[lemma],
+                    author=args.author,
+                    title=args.title,
+                    start=1,
+                    page_size=args.page_size,
+                ),
+                lemmas,
+            )
+        )
 
-    results_length = int(data_initial.get("results_length", 0) or 0)
-    if args.verbose:
-        print(f"Found {results_length} result(s).", file=sys.stderr)
+    results_length = 0
+    for lemma, first_page in zip(lemmas, first_pages):
+        length = int(first_page.get("results_length", 0) or 0)
+        if args.verbose:
+            print(f"Found {length} result(s) for {lemma}.", file=sys.stderr)
+        results_length += length
 
     if results_length == 0:
         print("No results found for this query.", file=sys.stderr)
         # Still create an empty CSV with just headers
-        write_csv([], args.output)
+        write_csv([], args.output, bom=args.bom)
         print(f"Extracted 0 tokens into {args.output}")
         return
 
-    # Second query: fetch the full set with end=results_length
-    params_full = build_query_params(
-        lemmas=args.lemmas,
-        author=args.author,
-        title=args.title,
-        start=1,
-        end=results_length,
+    rows = chain.from_iterable(
+        iter_rows(
+            iter_results(
+                first_page,
+                lemmas=[lemma],
+                author=args.author,
+                title=args.title,
+                page_size=args.page_size,
+            ),
+            lemma,
+            args.language,
+        )
+        for lemma, first_page in zip(lemmas, first_pages)
     )
-    data_full = fetch_json(params_full)
+    count = write_csv(rows, args.output, bom=args.bom)
 
-    rows = extract_rows(data_full, args.lemmas, args.language)
-    write_csv(rows, args.output)
+    if args.verbose:
+        info = _parse_context_cached.cache_info()
+        print(
+            f"Context parse cache: {info.hits} hit(s), {info.misses} miss(es).",
+            file=sys.stderr,
+        )
 
     # Simple output message with token count
-    print(f"Extracted {len(rows)} tokens into {args.output}")
+    print(f"Extracted {count} tokens into {args.output}")
 
 
 if __name__ == "__main__":